@@ -16,24 +16,94 @@ Original file is located at
 
 !ngrok authtoken 2r5XGVHUBV1QWWeEI2z0ehKCLRR_61EizzTfJJbozNZTyh9G1
 
+import io
+import os
+
+import pandas as pd
 import streamlit as st
 from pyspark.sql import SparkSession
 from pyngrok import ngrok
 from subdirectory.danaelbaba import calculate_return_rate, best_return_rate, calculate_correlation_between_stocks
 
-# Initialize Spark
-spark = SparkSession.builder.appName("Stock Analysis").getOrCreate()
+# Spark only pays off for very large uploads; pandas handles the usual few thousand rows
+USE_SPARK = os.getenv("STOCK_USE_SPARK") == "1"
+
+# Initialize Spark once per server rather than on every rerun
+@st.cache_resource
+def get_spark():
+    spark = SparkSession.builder.appName("Stock Analysis").getOrCreate()
+    spark.conf.set("spark.sql.adaptive.enabled", "true")
+
+    # Convert results with Arrow for toPandas()
+    spark.conf.set("spark.sql.execution.arrow.pyspark.enabled", "true")
+    spark.conf.set("spark.sql.execution.arrow.pyspark.fallback.enabled", "true")
+    return spark
+
+# The analyses need these columns; any others are carried along untouched
+REQUIRED_COLUMNS = ["Date", "Stock", "Close"]
+
+def check_required_columns(columns):
+    missing = [c for c in REQUIRED_COLUMNS if c not in columns]
+    if missing:
+        raise ValueError(f"missing required columns: {', '.join(missing)}")
+
+# Uploads are cached on their contents, so widget interactions don't re-parse the file.
+# Only the most recent few uploads are kept so the cache can't grow without bound.
+MAX_CACHED_UPLOADS = 4
+
+@st.cache_data(max_entries=MAX_CACHED_UPLOADS)
+def load_uploaded_pandas(file_name, file_bytes):
+    if file_name.lower().endswith(".parquet"):
+        df = pd.read_parquet(io.BytesIO(file_bytes))
+    else:
+        df = pd.read_csv(io.BytesIO(file_bytes))
+    check_required_columns(df.columns)
+    df["Date"] = pd.to_datetime(df["Date"])
+    return df
+
+# Spark DataFrames can't be pickled for st.cache_data, so they are cached as resources.
+# They are shared across sessions and entries can be evicted, so they are not
+# persisted here: nothing could safely release the Spark storage afterwards.
+@st.cache_resource(max_entries=MAX_CACHED_UPLOADS)
+def load_uploaded_spark(file_name, file_bytes):
+    # Parse the bytes with pandas rather than spilling them to a file for
+    # Spark to read, so there is no temporary file to clean up
+    return get_spark().createDataFrame(load_uploaded_pandas(file_name, file_bytes))
+
+def load_uploaded_file(uploaded_file):
+    if USE_SPARK:
+        return load_uploaded_spark(uploaded_file.name, uploaded_file.getvalue())
+    return load_uploaded_pandas(uploaded_file.name, uploaded_file.getvalue())
+
+@st.cache_resource(max_entries=1)
+def load_combined_dataset(path="combined.parquet"):
+    # Built once by build_dataset.py, so sessions never download from yfinance
+    if USE_SPARK:
+        return get_spark().read.parquet(path)
+    return pd.read_parquet(path)
+
+def to_pandas(df):
+    return df.toPandas() if USE_SPARK else df
 
 # Streamlit App
 st.title("Nasdaq Tech Stocks Analysis")
-st.markdown("Analyze Nasdaq tech stocks using Spark to generate actionable insights.")
+st.markdown("Analyze Nasdaq tech stocks to generate actionable insights.")
 
 # Upload stock data
-uploaded_file = st.file_uploader("Upload your stock data file (CSV format):", type=["csv"])
+uploaded_file = st.file_uploader("Upload your stock data file (CSV or Parquet format), or leave empty to use combined.parquet:", type=["csv", "parquet"])
 if uploaded_file:
-    # Load the data into Spark
-    df = spark.read.csv(uploaded_file, header=True, inferSchema=True)
-
+    # Load the data
+    try:
+        df = load_uploaded_file(uploaded_file)
+    except ValueError as e:
+        st.error(f"Could not load {uploaded_file.name}: {e}")
+        df = None
+elif os.path.exists("combined.parquet"):
+    df = load_combined_dataset()
+else:
+    df = None
+
+if df is not None:
     # Analysis options
     analysis_type = st.selectbox(
         "Select an analysis type:",
@@ -47,7 +117,7 @@ if uploaded_file:
         if st.button("Find Best Stock"):
             best_stock = best_return_rate(df, str(start_date), period=period)
             st.write("Top-performing stock:")
-            st.dataframe(best_stock.toPandas())
+            st.dataframe(to_pandas(best_stock))
 
     elif analysis_type == "Return Rate Analysis":
         # Return rate analysis
@@ -55,11 +125,11 @@ if uploaded_file:
         if st.button("Calculate Return Rates"):
             weekly_return, monthly_return, yearly_return = calculate_return_rate(df)
             st.write("Weekly Return Rates:")
-            st.dataframe(weekly_return.toPandas())
+            st.dataframe(to_pandas(weekly_return))
             st.write("Monthly Return Rates:")
-            st.dataframe(monthly_return.toPandas())
+            st.dataframe(to_pandas(monthly_return))
             st.write("Yearly Return Rates:")
-            st.dataframe(yearly_return.toPandas())
+            st.dataframe(to_pandas(yearly_return))
 
     elif analysis_type == "Correlation Analysis":
         # Correlation between stocks
@@ -75,7 +145,7 @@ st.write("Add visualizations using libraries like Matplotlib, Seaborn, or Plotly
 
 def main():
     st.title("Nasdaq Tech Stocks Analysis")
-    st.markdown("Analyze Nasdaq tech stocks using Spark to generate actionable insights.")
+    st.markdown("Analyze Nasdaq tech stocks to generate actionable insights.")
     st.write("Streamlit is running directly in Google Colab!")
 
 # Run Streamlit inline
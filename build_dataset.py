@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""build_dataset.py
+
+Fetch stock data using yfinance and save it as a single Parquet file.
+
+Run this once before the analysis script or the Streamlit app, which both
+load the resulting combined.parquet instead of downloading on every start.
+"""
+
+import pandas as pd
+import yfinance as yf
+
+stocks = ["AAPL", "MSFT", "GOOGL", "TSLA"]
+
+def build_dataset(stocks, start="2020-01-01", end="2023-12-31", path="combined.parquet"):
+    # Fetch data for all stocks in a single batched request
+    data = yf.download(stocks, start=start, end=end, group_by="ticker", threads=True, auto_adjust=False)
+
+    # Combine the stocks into a single long DataFrame with a Stock column
+    combined = pd.concat(
+        [data[stock].reset_index().assign(Stock=stock) for stock in stocks],
+        ignore_index=True
+    )
+    combined.columns.name = None
+
+    # Match the types of the Spark schema used by the analysis
+    combined["Date"] = combined["Date"].dt.date
+    combined["Volume"] = combined["Volume"].astype("float64")
+
+    combined.to_parquet(path, index=False, compression="snappy")
+    print(f"Saved {len(combined)} rows for {len(stocks)} stocks to {path}")
+    return combined
+
+if __name__ == "__main__":
+    build_dataset(stocks)
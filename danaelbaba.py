@@ -15,30 +15,29 @@ Automatically generated by Colab.
 Original file is located at
     https://colab.research.google.com/drive/1cC4ecw3xqjWmktectK-wesMhwjIdAaiZ
 
-### Fetch stock data using yfinance.
-"""
+### Load the stock data.
 
-import yfinance as yf
+The data is fetched with yfinance by build_dataset.py, which saves it to
+combined.parquet. Run that once before this script; the pipeline below runs
+from main(), so importing this module only defines the analysis functions.
+"""
 
-stocks = ["AAPL", "MSFT", "GOOGL", "TSLA"]
+import os
 
-# Fetch data for each stock and save as CSV
-for stock in stocks:
-    data = yf.download(stock, start="2020-01-01", end="2023-12-31")
-    data.reset_index(inplace=True)
-    data.to_csv(f"{stock}.csv", index=False)
+# Previews and schema dumps each run a Spark job, so only show them when debugging
+DEBUG = os.getenv("STOCK_DEBUG") == "1"
 
+from pyspark import StorageLevel
 from pyspark.sql import SparkSession
 import pandas as pd
+import numpy as np
 from pyspark.sql.window import Window
-from pyspark.sql.functions import col, sum, mean, min, corr, max, to_date, lag, lit
+from pyspark.sql.functions import col, sum, mean, min, corr, max, to_date, lag, lit, max_by, struct
 from pyspark.sql.types import *
 
 spark_application_name = "Stock Analysis"
-spark = (SparkSession.builder.appName(spark_application_name).getOrCreate())
-
-"""Read the CSV files into Spark DataFrames and combine them."""
 
+# Schema of the combined dataset written by build_dataset.py
 schema = StructType([
     StructField("Date", DateType(), True),
     StructField("Adj Close", DoubleType(), True),
@@ -50,128 +49,65 @@ schema = StructType([
     StructField("Stock", StringType(), False)
 ])
 
-dfs = []
-for stock in stocks:
-    # Read CSV with schema enforcement
-    df = spark.read.csv(f"{stock}.csv", header=True, schema=schema)
-
-    # Add a Stock column with the symbol
-    df = df.withColumn("Stock", lit(stock))
-    dfs.append(df)
-
-# Combine all stocks into a single DataFrame
-combined_df = dfs[0]
-for df in dfs[1:]:
-    combined_df = combined_df.union(df)
-
-# Print the schema and preview the DataFrame
-combined_df.printSchema()
-combined_df.show(5)
-
-# Check for null or invalid values
-combined_df.select([col(c).isNull().alias(f"null_{c}") for c in combined_df.columns]).show()
-
-# Confirm column data types
-combined_df.printSchema()
-
-"""### Pre-process the Data
-
-Ensure the Date column is in the correct format.
-"""
-
-combined_df = combined_df.withColumn("Date", to_date(col("Date"), "yyyy-MM-dd"))
-
-"""Drop rows with missing values."""
-
-combined_df = combined_df.dropna()
-
-"""Add Calculated Columns"""
-
-window_spec = Window.partitionBy("Stock").orderBy("Date")
-
-combined_df = combined_df.withColumn(
-    "Prev_Close", lag("Close").over(window_spec)
-).withColumn(
-    "Daily_Return", (col("Close") - col("Prev_Close")) / col("Prev_Close")
-)
-
-combined_df.show(5)
-
-"""Calculate a 5-day moving average for closing prices."""
-
-combined_df = combined_df.withColumn(
-    "Moving_Avg_5", mean("Close").over(window_spec.rowsBetween(-4, 0))
-)
-combined_df.show(5)
-
-"""## Aggregation and Analysis
-
-Calculate total, average, minimum, and maximum closing prices for each stock.
-"""
-
-summary_stats = combined_df.groupBy("Stock").agg(
-    sum("Close").alias("Total_Close"),
-    mean("Close").alias("Avg_Close"),
-    min("Close").alias("Min_Close"),
-    max("Close").alias("Max_Close")
-)
-summary_stats.show()
-
-"""Find the stock with the highest daily return."""
-
-highest_return = combined_df.orderBy(col("Daily_Return").desc()).select("Stock", "Date", "Daily_Return").first()
-print(f"Highest daily return: {highest_return}")
-
-combined_df.write.csv("processed_stocks1.csv", header=True)
-
-""" Show the First and Last 40 Rows"""
-
-combined_df.show(40)
-combined_df.orderBy(col("Date").desc()).limit(40).show(40, truncate=False)
-
-"""Get the Number of Observations"""
-
-num_observations = combined_df.count()
-print(f"Number of observations: {num_observations}")
-
 """Deduce the Period Between Data Points"""
 
-from pyspark.sql.functions import datediff
-
 def deduce_period(df):
-    # Ensure the DataFrame is sorted by Date
-    df = df.orderBy("Date")
+    # Collect the distinct dates once and sort them on the driver
+    dates = np.sort(pd.to_datetime(df.select("Date").distinct().toPandas()["Date"]).values)
+    if len(dates) < 2:
+        print("Not enough data points to deduce a period.")
+        return None
 
-    # Calculate difference between consecutive dates
-    window_spec = Window.orderBy("Date")
-    df = df.withColumn("Prev_Date", lag("Date").over(window_spec))
-    df = df.withColumn("Date_Diff", datediff(col("Date"), col("Prev_Date")))
+    # Calculate difference in days between consecutive dates
+    date_diffs = np.diff(dates).astype("timedelta64[D]").astype(int)
 
     # Determine the most common period
-    period = df.groupBy("Date_Diff").count().orderBy(col("count").desc()).first()
-    print(f"Most common period: {period['Date_Diff']} days")
-    return period['Date_Diff']
-deduce_period(combined_df)
+    period = int(np.bincount(date_diffs).argmax())
+    print(f"Most common period: {period} days")
+    return period
 
 """Descriptive Statistics"""
 
-from pyspark.sql.functions import mean, stddev
+from pyspark.sql.functions import col, count, sum, mean, stddev, min, max
+
+def summarize_columns(df):
+    # Like describe(): numeric columns get every statistic, string columns count, min and max
+    numeric_cols = [col_name for col_name, dtype in df.dtypes if dtype in ("int", "bigint", "double")]
+    described_cols = [col_name for col_name, dtype in df.dtypes if dtype in ("int", "bigint", "double", "string")]
+    summary_names = ["count", "mean", "stddev", "min", "max"]
+
+    # Compute every statistic and the missing value counts in a single pass
+    summary = df.agg(
+        *[count(c).alias(f"count_{c}") for c in described_cols],
+        *[mean(c).alias(f"mean_{c}") for c in numeric_cols],
+        *[stddev(c).alias(f"stddev_{c}") for c in numeric_cols],
+        *[min(c).alias(f"min_{c}") for c in described_cols],
+        *[max(c).alias(f"max_{c}") for c in described_cols],
+        *[sum(col(c).isNull().cast("int")).alias(f"missing_{c}") for c in df.columns]
+    ).first().asDict()
+
+    stats = pd.DataFrame(
+        {c: [summary.get(f"{name}_{c}") for name in summary_names] for c in described_cols},
+        index=summary_names
+    )
+    missing_counts = pd.Series({c: summary[f"missing_{c}"] for c in df.columns})
+    return stats, missing_counts
 
 def descriptive_statistics(df):
-    stats = df.describe()
-    print("Descriptive Statistics:")
-    stats.show()
-descriptive_statistics(combined_df)
+    stats, missing_counts = summarize_columns(df)
 
-from pyspark.sql.functions import col, sum
+    print("Descriptive Statistics:")
+    print(stats)
+    print("Missing Values:")
+    print(missing_counts)
+    return stats, missing_counts
 
 def count_missing_values(df):
-    missing_counts = df.select(
-        *[(sum(col(c).isNull().cast("int")).alias(f"missing_{c}")) for c in df.columns]
-    )
+    _, missing_counts = summarize_columns(df)
+
     print("Missing Values:")
-    missing_counts.show()
-count_missing_values(combined_df)
+    print(missing_counts)
+    return missing_counts
 
 """Correlation Between Values"""
 
@@ -185,18 +121,16 @@ def calculate_correlation_matrix(df):
         print("No numeric columns available for correlation.")
         return
 
+    # Collect the numeric columns once and compute every pair in a single matrix operation
+    values = df.select(numeric_cols).dropna().toPandas().to_numpy()
+    matrix = np.corrcoef(values, rowvar=False)
+
     correlation_matrix = {}
 
     print("Correlation Matrix:")
     for i, col1 in enumerate(numeric_cols):
-        for col2 in numeric_cols[i:]:  # Avoid duplicate pairs
-            if col1 == col2:
-                correlation_value = 1.0
-            else:
-                correlation_value = df.stat.corr(col1, col2)
-
-            correlation_matrix[(col1, col2)] = correlation_value
-            correlation_matrix[(col2, col1)] = correlation_value
+        for j, col2 in enumerate(numeric_cols):
+            correlation_matrix[(col1, col2)] = matrix[i, j]
 
     # Print the matrix
     print(f"{'':<15}", end="")
@@ -209,100 +143,109 @@ def calculate_correlation_matrix(df):
             print(f"{correlation_matrix[(col1, col2)]:<15.2f}", end="")
         print()
 
-calculate_correlation_matrix(combined_df)
-
 """Average of Opening and Closing Prices for Each Stock (Week, Month, Year)"""
 
 def calculate_average_prices_for_stock(df, stock=None):
     from pyspark.sql.functions import year, month, weekofyear, avg
 
+    # Keep only the columns the averages need, and the requested stock
+    df = df.select("Stock", "Date", "Open", "Close")
+    if stock:
+        df = df.filter(df["Stock"] == stock)
+
     df = df.withColumn("Year", year("Date")) \
            .withColumn("Month", month("Date")) \
            .withColumn("Week", weekofyear("Date"))
 
-    if stock:
-        df = df.filter(df["Stock"] == stock)
-
     avg_prices = df.groupBy("Stock", "Year", "Month", "Week") \
                    .agg(avg("Open").alias("Avg_Open"), avg("Close").alias("Avg_Close"))
 
-    avg_prices.orderBy("Stock", "Year", "Month", "Week").show(50)  # Adjust number of rows displayed as needed
+    if DEBUG:
+        avg_prices.orderBy("Stock", "Year", "Month", "Week").show(50)  # Adjust number of rows displayed as needed
     return avg_prices
 
-calculate_average_prices_for_stock(combined_df, stock="AAPL")
-calculate_average_prices_for_stock(combined_df, stock="MSFT")
-calculate_average_prices_for_stock(combined_df, stock="GOOGL")
-calculate_average_prices_for_stock(combined_df, stock="TSLA")
-
 """Daily and Monthly Changes in Stock Prices
 
 """
 
-combined_df.select("Stock").distinct().show()
-
 def calculate_daily_return(df):
-    df = df.withColumn("Daily_Return", (col("Close") - lag("Close").over(window_spec)) / lag("Close").over(window_spec))
+    # Partition by Stock so the window runs per stock instead of on a single partition
+    window_spec = Window.partitionBy("Stock").orderBy("Date")
+    prev_close = lag("Close").over(window_spec)
+    df = df.withColumn("Daily_Return", (col("Close") - prev_close) / prev_close)
 
-    df.show(10)
+    if DEBUG:
+        df.show(10)
     return df
-calculate_daily_return(combined_df)
 
 """To find the stocks with the highest daily return we do the following:"""
 
-from pyspark.sql.functions import col, max
+from pyspark.sql.functions import col, max, max_by, struct
 
 def get_stock_with_highest_daily_return(df):
     # Find the maximum daily return for each stock
     stock_max_return = df.groupBy("Stock").agg(max("Daily_Return").alias("Max_Daily_Return"))
 
     # Find the stock with the overall highest daily return
-    highest_return = stock_max_return.orderBy(col("Max_Daily_Return").desc()).limit(1)
+    highest_return = stock_max_return.agg(
+        max_by(struct("Stock", "Max_Daily_Return"), "Max_Daily_Return").alias("Highest_Return")
+    ).filter(col("Highest_Return").isNotNull()).select("Highest_Return.*")
 
     # Show the results
-    stock_max_return.show()  # Max daily return per stock
-    highest_return.show()    # Stock with the highest daily return overall
+    if DEBUG:
+        stock_max_return.show()  # Max daily return per stock
+        highest_return.show()    # Stock with the highest daily return overall
 
     return stock_max_return, highest_return
 
-stock_max_return, highest_return = get_stock_with_highest_daily_return(combined_df)
-
 """Calculate the average daily return for different periods like week, month, and year"""
 
 from pyspark.sql.functions import year, month, weekofyear, avg
 
-def calculate_average_daily_return(df):
-
-    # Extract year, month, and week information
+def aggregate_by_period(df, aggregations):
+    # Add Year, Month, and Week columns
     df = df.withColumn("Year", year("Date")) \
            .withColumn("Month", month("Date")) \
            .withColumn("Week", weekofyear("Date"))
 
-    # Calculate average daily return per week
-    weekly_avg_return = df.groupBy("Stock", "Year", "Week") \
-                          .agg(avg("Daily_Return").alias("Avg_Daily_Return_Weekly"))
+    # Aggregate per week, month and year in a single shuffle, computing only the
+    # three grouping sets that are needed. grouping() flags which of Month and
+    # Week were rolled up at each level. The returned frames are lazy.
+    grouped = df.sparkSession.sql(f"""
+        SELECT Stock, Year, Month, Week, {aggregations},
+               grouping(Month) AS Month_Rolled_Up,
+               grouping(Week) AS Week_Rolled_Up
+        FROM {{df}}
+        GROUP BY GROUPING SETS ((Stock, Year, Week), (Stock, Year, Month), (Stock, Year))
+    """, df=df)
+
+    rolled_up = ["Month_Rolled_Up", "Week_Rolled_Up"]
+    weekly = grouped.filter((col("Month_Rolled_Up") == 1) & (col("Week_Rolled_Up") == 0)).drop("Month", *rolled_up)
+    monthly = grouped.filter((col("Month_Rolled_Up") == 0) & (col("Week_Rolled_Up") == 1)).drop("Week", *rolled_up)
+    yearly = grouped.filter((col("Month_Rolled_Up") == 1) & (col("Week_Rolled_Up") == 1)).drop("Month", "Week", *rolled_up)
+    return weekly, monthly, yearly
 
-    # Calculate average daily return per month
-    monthly_avg_return = df.groupBy("Stock", "Year", "Month") \
-                           .agg(avg("Daily_Return").alias("Avg_Daily_Return_Monthly"))
+def calculate_average_daily_return(df):
 
-    # Calculate average daily return per year
-    yearly_avg_return = df.groupBy("Stock", "Year") \
-                          .agg(avg("Daily_Return").alias("Avg_Daily_Return_Yearly"))
+    # Calculate average daily return per week, month and year
+    weekly, monthly, yearly = aggregate_by_period(df, "avg(Daily_Return) AS Avg_Daily_Return")
+    weekly_avg_return = weekly.withColumnRenamed("Avg_Daily_Return", "Avg_Daily_Return_Weekly")
+    monthly_avg_return = monthly.withColumnRenamed("Avg_Daily_Return", "Avg_Daily_Return_Monthly")
+    yearly_avg_return = yearly.withColumnRenamed("Avg_Daily_Return", "Avg_Daily_Return_Yearly")
 
     # Display the results
-    print("Weekly Average Daily Return:")
-    weekly_avg_return.orderBy("Stock", "Year", "Week").show(10)
+    if DEBUG:
+        print("Weekly Average Daily Return:")
+        weekly_avg_return.orderBy("Stock", "Year", "Week").show(10)
 
-    print("Monthly Average Daily Return:")
-    monthly_avg_return.orderBy("Stock", "Year", "Month").show(10)
+        print("Monthly Average Daily Return:")
+        monthly_avg_return.orderBy("Stock", "Year", "Month").show(10)
 
-    print("Yearly Average Daily Return:")
-    yearly_avg_return.orderBy("Stock", "Year").show(10)
+        print("Yearly Average Daily Return:")
+        yearly_avg_return.orderBy("Stock", "Year").show(10)
 
     return weekly_avg_return, monthly_avg_return, yearly_avg_return
 
-weekly_avg, monthly_avg, yearly_avg = calculate_average_daily_return(combined_df)
-
 """Yearly Returns: The yearly average daily returns show that most stocks maintained relatively stable performance, with values typically close to zero. However, certain years (AAPL in 2022 with -9.92) exhibit significant negative performance, potentially indicating a challenging year for that stock.
 
 Monthly and Weekly Volatility: The monthly and weekly average daily returns for AAPL show fluctuations, with some months (May 2020 and July 2020) having positive returns, while others (February 2020 and September 2020) show negative returns. These variations reflect the inherent volatility of stock prices over shorter periods.
@@ -328,22 +271,15 @@ def calculate_moving_average(df, column_name, num_points):
     df = df.withColumn(moving_avg_column, avg(col(column_name)).over(window_spec))
 
     # Show a sample of the resulting DataFrame
-    df.show(10)
+    if DEBUG:
+        df.show(10)
 
     return df
 
-# Calculate the 5-period moving average for the 'Open' column
-combined_df_with_moving_avg = calculate_moving_average(combined_df, "Open", 5)
-
 """Analyze the Results Across All Stocks:"""
 
 from pyspark.sql.functions import avg
 
-avg_moving_avg = combined_df_with_moving_avg.groupBy("Stock").agg(
-    avg("Moving_Avg_Open_5").alias("Avg_Moving_Avg_Open_5")
-)
-avg_moving_avg.show()
-
 """We can see that MSFT has the highest average 5-period moving average of opening prices (262.24), indicating consistently higher opening prices compared to other stocks.
 GOOGL has the lowest average moving average (107.65), suggesting it has lower overall opening prices in comparison.
 Finally, TSLA and AAPL are in the middle range, with TSLA showing slightly higher average opening prices than AAPL.
@@ -358,14 +294,23 @@ Calculate the correlation between two stocks based on a specified column.
     :return: Correlation value between the two stocks
 """
 
+from pyspark.sql.functions import broadcast
+
 def calculate_correlation_between_stocks(df, stock1, stock2, column="Close"):
 
+    # Small datasets loaded with pandas skip Spark entirely
+    if isinstance(df, pd.DataFrame):
+        return calculate_correlation_between_stocks_pandas(df, stock1, stock2, column)
+
+    # Keep only the columns the correlation needs
+    df = df.select("Stock", "Date", column)
+
     # Filter data for the two stocks
     stock1_data = df.filter(col("Stock") == stock1).select("Date", col(column).alias(f"{column}_{stock1}"))
     stock2_data = df.filter(col("Stock") == stock2).select("Date", col(column).alias(f"{column}_{stock2}"))
 
-    # Join the two stocks' data on Date
-    joined_data = stock1_data.join(stock2_data, on="Date", how="inner")
+    # Join the two stocks' data on Date; one stock's rows are small enough to broadcast
+    joined_data = stock1_data.join(broadcast(stock2_data), on="Date", how="inner")
 
     # Calculate the correlation
     correlation = joined_data.stat.corr(f"{column}_{stock1}", f"{column}_{stock2}")
@@ -373,12 +318,37 @@ def calculate_correlation_between_stocks(df, stock1, stock2, column="Close"):
     print(f"Correlation between {stock1} and {stock2} based on {column}: {correlation}")
     return correlation
 
-calculate_correlation_between_stocks(combined_df, "AAPL", "MSFT", column="Close")
-calculate_correlation_between_stocks(combined_df, "AAPL", "GOOGL", column="Close")
-calculate_correlation_between_stocks(combined_df, "AAPL", "TSLA", column="Close")
-calculate_correlation_between_stocks(combined_df, "MSFT", "GOOGL", column="Close")
-calculate_correlation_between_stocks(combined_df, "MSFT", "TSLA", column="Close")
-calculate_correlation_between_stocks(combined_df, "GOOGL", "TSLA", column="Close")
+def calculate_correlation_between_stocks_pandas(df, stock1, stock2, column="Close"):
+
+    # Align the two stocks' data on Date
+    stock1_data = df.loc[df["Stock"] == stock1, ["Date", column]]
+    stock2_data = df.loc[df["Stock"] == stock2, ["Date", column]]
+    joined_data = stock1_data.merge(stock2_data, on="Date", suffixes=(f"_{stock1}", f"_{stock2}"))
+
+    # Calculate the correlation
+    correlation = np.corrcoef(joined_data[f"{column}_{stock1}"], joined_data[f"{column}_{stock2}"])[0, 1]
+
+    print(f"Correlation between {stock1} and {stock2} based on {column}: {correlation}")
+    return correlation
+
+from pyspark.sql.functions import first
+
+def calculate_correlation_between_all_stocks(df, stocks, column="Close"):
+
+    # Pivot to one column per stock, keeping only dates every stock traded on
+    wide_data = df.groupBy("Date").pivot("Stock", stocks).agg(first(column)).dropna().toPandas()
+
+    # A single corrcoef call covers every pair of stocks
+    matrix = np.corrcoef(wide_data[stocks].to_numpy(), rowvar=False)
+
+    correlations = {}
+    for i, stock1 in enumerate(stocks):
+        for j in range(i + 1, len(stocks)):
+            stock2 = stocks[j]
+            correlations[(stock1, stock2)] = matrix[i, j]
+            print(f"Correlation between {stock1} and {stock2} based on {column}: {matrix[i, j]}")
+
+    return correlations
 
 """We notice that strongest correlation: AAPL and MSFT (0.93) show the highest correlation, reflecting similar market trends in the tech sector.
 
@@ -395,46 +365,72 @@ Calculate return rate from grouped data that includes first and last close price
     :return: DataFrame with calculated return rate
 """
 
-from pyspark.sql.functions import first, last, col
+from pyspark.sql.functions import col
 
 def calculate_return_rate(df):
 
-    # Add Year, Month, and Week columns
-    df = df.withColumn("Year", year("Date")) \
-           .withColumn("Month", month("Date")) \
-           .withColumn("Week", weekofyear("Date"))
+    if isinstance(df, pd.DataFrame):
+        return calculate_return_rate_pandas(df)
 
-    # Calculate return rate per week
-    weekly_return = df.groupBy("Stock", "Year", "Week").agg(
-        first("Close").alias("First_Close"),
-        last("Close").alias("Last_Close")
-    ).withColumn("Weekly_Return_Rate", ((col("Last_Close") - col("First_Close")) / col("First_Close")) * 100)
+    # Keep only the columns the return rates need
+    df = df.select("Stock", "Date", "Close")
 
-    # Calculate return rate per month
-    monthly_return = df.groupBy("Stock", "Year", "Month").agg(
-        first("Close").alias("First_Close"),
-        last("Close").alias("Last_Close")
-    ).withColumn("Monthly_Return_Rate", ((col("Last_Close") - col("First_Close")) / col("First_Close")) * 100)
+    # Take the first and last close of each week, month and year by date
+    weekly, monthly, yearly = aggregate_by_period(
+        df, "min_by(Close, Date) AS First_Close, max_by(Close, Date) AS Last_Close"
+    )
+
+    def with_return_rate(grouped, return_column):
+        return grouped.withColumn(return_column, ((col("Last_Close") - col("First_Close")) / col("First_Close")) * 100)
 
-    # Calculate return rate per year
-    yearly_return = df.groupBy("Stock", "Year").agg(
-        first("Close").alias("First_Close"),
-        last("Close").alias("Last_Close")
-    ).withColumn("Yearly_Return_Rate", ((col("Last_Close") - col("First_Close")) / col("First_Close")) * 100)
+    weekly_return = with_return_rate(weekly, "Weekly_Return_Rate")
+    monthly_return = with_return_rate(monthly, "Monthly_Return_Rate")
+    yearly_return = with_return_rate(yearly, "Yearly_Return_Rate")
 
     # Display the results
-    print("Weekly Return Rate:")
-    weekly_return.orderBy("Stock", "Year", "Week").show(10)
+    if DEBUG:
+        print("Weekly Return Rate:")
+        weekly_return.orderBy("Stock", "Year", "Week").show(10)
 
-    print("Monthly Return Rate:")
-    monthly_return.orderBy("Stock", "Year", "Month").show(10)
+        print("Monthly Return Rate:")
+        monthly_return.orderBy("Stock", "Year", "Month").show(10)
 
-    print("Yearly Return Rate:")
-    yearly_return.orderBy("Stock", "Year").show(10)
+        print("Yearly Return Rate:")
+        yearly_return.orderBy("Stock", "Year").show(10)
 
     return weekly_return, monthly_return, yearly_return
 
-weekly_return, monthly_return, yearly_return = calculate_return_rate(combined_df)
+def calculate_return_rate_pandas(df):
+
+    # Add Year, Month, and Week columns, keeping each stock in date order
+    dates = pd.to_datetime(df["Date"])
+    df = df.assign(Date=dates, Year=dates.dt.year, Month=dates.dt.month,
+                   Week=dates.dt.isocalendar().week.astype(int)).sort_values(["Stock", "Date"])
+
+    def period_return(group_by_cols, return_column):
+        grouped = df.groupby(group_by_cols, as_index=False).agg(
+            First_Close=("Close", "first"),
+            Last_Close=("Close", "last")
+        )
+        grouped[return_column] = ((grouped["Last_Close"] - grouped["First_Close"]) / grouped["First_Close"]) * 100
+        return grouped
+
+    weekly_return = period_return(["Stock", "Year", "Week"], "Weekly_Return_Rate")
+    monthly_return = period_return(["Stock", "Year", "Month"], "Monthly_Return_Rate")
+    yearly_return = period_return(["Stock", "Year"], "Yearly_Return_Rate")
+
+    # Display the results
+    if DEBUG:
+        print("Weekly Return Rate:")
+        print(weekly_return.head(10))
+
+        print("Monthly Return Rate:")
+        print(monthly_return.head(10))
+
+        print("Yearly Return Rate:")
+        print(yearly_return.head(10))
+
+    return weekly_return, monthly_return, yearly_return
 
 """The weekly returns for AAPL in 2020 were generally stable, with minor fluctuations. The highest weekly return was +3.68% in week 6, while the largest drop was -8.32% in week 9, indicating some short-term volatility. In contrast, the monthly returns exhibited greater volatility, ranging from a sharp decline of -14.89% in March 2020 to a strong recovery of +21.95% in April 2020. This highlights the significant market recovery following initial losses. Overall, early 2020 was marked by steep declines and recoveries, while later months, such as October 2020, showed declining performance, reflecting a potential market slowdown towards the end of the year.
 
@@ -446,44 +442,189 @@ Calculate the stock with the best return rate for a specific month or year.
     :return: The stock with the best return rate for the specified period.
 """
 
-from pyspark.sql.functions import col, first, last, year, month
-
-def best_return_rate(df, start_date, period="month"):
+from datetime import date
 
-    # Extract Year and Month from the Date column
-    df = df.withColumn("Year", year("Date")).withColumn("Month", month("Date"))
+from pyspark.sql.functions import col, lit, min_by, max_by, struct
 
+def period_date_range(start_date, period):
     # Parse the start date
     start_year, start_month, _ = map(int, start_date.split("-"))
 
-    # Filter data based on the specified period
+    # Work out the date range of the specified period, and the Year and Month it covers
     if period == "month":
-        filtered_df = df.filter((col("Year") == start_year) & (col("Month") == start_month))
-        group_by_cols = ["Stock", "Year", "Month"]
+        from_date = date(start_year, start_month, 1)
+        to_date_exclusive = date(start_year + start_month // 12, start_month % 12 + 1, 1)
+        period_values = {"Year": start_year, "Month": start_month}
     elif period == "year":
-        filtered_df = df.filter(col("Year") == start_year)
-        group_by_cols = ["Stock", "Year"]
+        from_date = date(start_year, 1, 1)
+        to_date_exclusive = date(start_year + 1, 1, 1)
+        period_values = {"Year": start_year}
     else:
         raise ValueError("Invalid period. Choose 'month' or 'year'.")
 
+    return from_date, to_date_exclusive, period_values
+
+def best_return_rate(df, start_date, period="month"):
+
+    if isinstance(df, pd.DataFrame):
+        return best_return_rate_pandas(df, start_date, period)
+
+    from_date, to_date_exclusive, period_values = period_date_range(start_date, period)
+    period_cols = [lit(value).alias(name) for name, value in period_values.items()]
+
+    # Filter on Date directly so the predicate can be pushed down to the scan,
+    # keeping only the columns needed for the return rate
+    filtered_df = df.select("Stock", "Date", "Close") \
+                    .filter((col("Date") >= lit(from_date)) & (col("Date") < lit(to_date_exclusive)))
+
+    # Group data and calculate return rate
+    return_rate_df = filtered_df.groupBy("Stock").agg(
+        min_by("Close", "Date").alias("First_Close"),
+        max_by("Close", "Date").alias("Last_Close")
+    ).select("Stock", *period_cols, "First_Close", "Last_Close") \
+     .withColumn("Return_Rate", ((col("Last_Close") - col("First_Close")) / col("First_Close")) * 100)
+
+    # Find the stock with the best return rate; the aggregate yields a null
+    # struct when no data falls in the period, so drop it to return no rows
+    best_stock = return_rate_df.agg(
+        max_by(struct(*return_rate_df.columns), "Return_Rate").alias("Best_Stock")
+    ).filter(col("Best_Stock").isNotNull()).select("Best_Stock.*")
+
+    # Show the result
+    if DEBUG:
+        best_stock.show()
+
+    return best_stock
+
+def best_return_rate_pandas(df, start_date, period="month"):
+
+    from_date, to_date_exclusive, period_values = period_date_range(start_date, period)
+
+    # Filter on the same date range as the Spark version, keeping each stock in date order
+    dates = pd.to_datetime(df["Date"])
+    filtered_df = df.assign(Date=dates)[(dates >= pd.Timestamp(from_date)) & (dates < pd.Timestamp(to_date_exclusive))] \
+                    .sort_values(["Stock", "Date"])
+
     # Group data and calculate return rate
-    return_rate_df = filtered_df.groupBy(group_by_cols).agg(
-        first("Close").alias("First_Close"),
-        last("Close").alias("Last_Close")
-    ).withColumn("Return_Rate", ((col("Last_Close") - col("First_Close")) / col("First_Close")) * 100)
+    return_rate_df = filtered_df.groupby("Stock", as_index=False).agg(
+        First_Close=("Close", "first"),
+        Last_Close=("Close", "last")
+    )
+    return_rate_df = return_rate_df.assign(**period_values)[["Stock", *period_values, "First_Close", "Last_Close"]]
+    return_rate_df["Return_Rate"] = ((return_rate_df["Last_Close"] - return_rate_df["First_Close"]) / return_rate_df["First_Close"]) * 100
 
     # Find the stock with the best return rate
-    best_stock = return_rate_df.orderBy(col("Return_Rate").desc()).limit(1)
+    best_stock = return_rate_df.nlargest(1, "Return_Rate")
 
     # Show the result
-    best_stock.show()
+    if DEBUG:
+        print(best_stock)
 
     return best_stock
 
-# Find the stock with the best return rate for January 2020
-best_stock = best_return_rate(combined_df, "2020-01-01", period="month")
+"""For January 2020, Tesla achieved the highest return rate of 51.20%, indicating significant growth in its stock price during the month. For the entire year of 2020, Tesla maintained its position as the top-performing stock with a staggering annual return rate of 720.05%, highlighting its remarkable performance and market demand throughout the year."""
+
+def main():
+    spark = (SparkSession.builder.appName(spark_application_name)
+             .config("spark.sql.shuffle.partitions", "4")  # The dataset is only a few thousand rows
+             .getOrCreate())
+
+    # Read the dataset built by build_dataset.py with schema enforcement
+    combined_df = spark.read.schema(schema).parquet("combined.parquet")
 
-# Find the stock with the best return rate for 2020
-best_stock_year = best_return_rate(combined_df, "2020-01-01", period="year")
+    if DEBUG:
+        # Print the schema and preview the DataFrame
+        combined_df.printSchema()
+        combined_df.show(5)
+
+        # Check for null or invalid values
+        combined_df.select([col(c).isNull().alias(f"null_{c}") for c in combined_df.columns]).show()
+
+    # Pre-process the data: ensure the Date column is in the correct format
+    # and drop rows with missing values
+    combined_df = combined_df.withColumn("Date", to_date(col("Date"), "yyyy-MM-dd"))
+    combined_df = combined_df.dropna()
+
+    # Hash-partition by Stock, sorted by Date, once up front. Every window below
+    # partitions by Stock and orders by Date, so none of them needs another shuffle.
+    combined_df = combined_df.repartition("Stock").sortWithinPartitions("Stock", "Date")
+
+    window_spec = Window.partitionBy("Stock").orderBy("Date")
+
+    # Add the previous close, the daily return and a 5-day moving average of
+    # closing prices in a single projection
+    prev_close = lag("Close").over(window_spec)
+
+    combined_df = combined_df.select(
+        "*",
+        prev_close.alias("Prev_Close"),
+        ((col("Close") - prev_close) / prev_close).alias("Daily_Return"),
+        mean("Close").over(window_spec.rowsBetween(-4, 0)).alias("Moving_Avg_5")
+    )
 
-"""For January 2020, Tesla achieved the highest return rate of 51.20%, indicating significant growth in its stock price during the month. For the entire year of 2020, Tesla maintained its position as the top-performing stock with a staggering annual return rate of 720.05%, highlighting its remarkable performance and market demand throughout the year."""
\ No newline at end of file
+    # Every analysis below reuses the preprocessed data, so materialize it once;
+    # the cached data keeps its partitioning by Stock
+    combined_df = combined_df.persist(StorageLevel.MEMORY_AND_DISK)
+    num_observations = combined_df.count()
+    print(f"Number of observations: {num_observations}")
+    if DEBUG:
+        combined_df.show(5)
+
+    stocks = [row["Stock"] for row in combined_df.select("Stock").distinct().orderBy("Stock").collect()]
+
+    if DEBUG:
+        # Calculate total, average, minimum, and maximum closing prices for each stock
+        summary_stats = combined_df.groupBy("Stock").agg(
+            sum("Close").alias("Total_Close"),
+            mean("Close").alias("Avg_Close"),
+            min("Close").alias("Min_Close"),
+            max("Close").alias("Max_Close")
+        )
+        summary_stats.show()
+
+    # Find the stock with the highest daily return
+    highest_return = combined_df.agg(
+        max_by(struct("Stock", "Date", "Daily_Return"), "Daily_Return").alias("Highest_Return")
+    ).filter(col("Highest_Return").isNotNull()).select("Highest_Return.*").first()
+    print(f"Highest daily return: {highest_return}")
+
+    combined_df.write.mode("overwrite").option("compression", "snappy").partitionBy("Stock").parquet("processed_stocks.parquet")
+
+    if DEBUG:
+        # Show the first and last 40 rows
+        combined_df.show(40)
+        combined_df.orderBy(col("Date").desc()).limit(40).show(40, truncate=False)
+
+    deduce_period(combined_df)
+    descriptive_statistics(combined_df)
+    calculate_correlation_matrix(combined_df)
+
+    if DEBUG:
+        # These analyses only display their results, so skip them otherwise
+        for stock in stocks:
+            calculate_average_prices_for_stock(combined_df, stock=stock)
+
+        calculate_daily_return(combined_df)
+        get_stock_with_highest_daily_return(combined_df)
+        calculate_average_daily_return(combined_df)
+
+        # Calculate the 5-period moving average for the 'Open' column and
+        # compare it across all stocks
+        combined_df_with_moving_avg = calculate_moving_average(combined_df, "Open", 5)
+        avg_moving_avg = combined_df_with_moving_avg.groupBy("Stock").agg(
+            avg("Moving_Avg_Open_5").alias("Avg_Moving_Avg_Open_5")
+        )
+        avg_moving_avg.show()
+
+        calculate_return_rate(combined_df)
+
+    calculate_correlation_between_all_stocks(combined_df, stocks, column="Close")
+
+    # Find the stock with the best return rate for January 2020, then for all of 2020
+    best_return_rate(combined_df, "2020-01-01", period="month")
+    best_return_rate(combined_df, "2020-01-01", period="year")
+
+    combined_df.unpersist()
+
+if __name__ == "__main__":
+    main()